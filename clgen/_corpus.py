@@ -506,7 +506,10 @@ class Corpus(clgen.CLgenObject):
         c = db.cursor()
 
         # if preservering order, order by line count. Else, order randomly
-        orderby = "LC(contents)" if self.opts["preserve_order"] else "RANDOM()"
+        if self.opts["preserve_order"]:
+            orderby = dbutil.sql_linecount("contents")
+        else:
+            orderby = "RANDOM()"
 
         c.execute("SELECT PreprocessedFiles.Contents FROM PreprocessedFiles "
                   "WHERE status=0 ORDER BY {orderby}".format(orderby=orderby))
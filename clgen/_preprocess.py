@@ -19,27 +19,29 @@
 """
 Preprocess OpenCL files for machine learning.
 """
+import atexit
 import json
 import labm8
-import math
 import os
 import progressbar
-import random
 import re
 import shutil
-import sqlite3
+import signal
 import sys
+import time
 
-from functools import partial
+from collections import Counter, deque
+from functools import lru_cache, partial
 from io import open
+from labm8 import crypto
 from labm8 import fs
 from multiprocessing import cpu_count, Pool
 from queue import Queue
 from queue import Empty as QueueEmpty
-from subprocess import Popen, PIPE, STDOUT
-from tempfile import NamedTemporaryFile
-from threading import Thread
-from typing import Dict, List, Tuple
+from subprocess import Popen, PIPE, STDOUT, TimeoutExpired
+from tempfile import NamedTemporaryFile, TemporaryFile
+from threading import Lock, Thread
+from typing import Dict, List, Tuple, Union
 
 
 import clgen
@@ -128,6 +130,99 @@ class GPUVerifyTimeoutException(GPUVerifyException):
     pass
 
 
+def _num_cpus() -> int:
+    """
+    Get the number of CPUs that this process may run on.
+
+    Unlike cpu_count(), this respects CPU affinity masks, so that a process
+    restricted to a subset of the machine's CPUs (e.g. by taskset or a
+    container) doesn't oversubscribe them.
+
+    Returns
+    -------
+    int
+        Number of usable CPUs.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return cpu_count()
+
+
+def _communicate(cmd: List[str], input: bytes=None, timeout: int=60,
+                 stderr=PIPE) -> Tuple[int, bytes, bytes]:
+    """
+    Run a command to completion, killing it if it exceeds the timeout.
+
+    Enforcing the timeout in-process avoids the extra fork+exec of wrapping
+    every command in `timeout -s9`.
+
+    Parameters
+    ----------
+    cmd : List[str]
+        Command to execute.
+    input : bytes, optional
+        Data to send to stdin.
+    timeout : int, optional
+        Number of seconds before the process is killed.
+    stderr : optional
+        Destination for stderr, e.g. PIPE or STDOUT.
+
+    Returns
+    -------
+    Tuple[int, bytes, bytes]
+        Return code, stdout, and stderr. If the process timed out, the return
+        code is -9.
+    """
+    # Run in a new session, so that on timeout we can kill any processes the
+    # command spawned (e.g. clang -cc1), as `timeout -s9` did. Otherwise
+    # they would hold stdout and stderr open, and communicate() would block
+    # until they exit.
+    process = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=stderr,
+                    start_new_session=True)
+    try:
+        stdout, stderr = process.communicate(input, timeout=timeout)
+    except TimeoutExpired:
+        _kill_process_group(process)
+        stdout, stderr = process.communicate()
+    return process.returncode, stdout, stderr
+
+
+def _kill_process_group(process: Popen) -> None:
+    """
+    SIGKILL a process started with start_new_session=True, and its children.
+
+    Parameters
+    ----------
+    process : Popen
+        Process.
+    """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass  # process group has already exited
+
+
+def _write_stdin(process: Popen, input: bytes) -> None:
+    """
+    Write input to a process and close its stdin.
+
+    Parameters
+    ----------
+    process : Popen
+        Process.
+    input : bytes
+        Input.
+    """
+    try:
+        process.stdin.write(input)
+    except BrokenPipeError:
+        pass  # process has exited, or was killed
+    try:
+        process.stdin.close()
+    except BrokenPipeError:
+        pass
+
+
 # FIXME(polyglot):
 CLANG_CL_TARGETS = [
     'nvptx64-nvidia-nvcl',
@@ -136,11 +231,16 @@ CLANG_CL_TARGETS = [
 
 
 # FIXME(polyglot):
+@lru_cache(maxsize=8)
 def clang_cl_args(target: str=CLANG_CL_TARGETS[0],
-                  use_shim: bool=True, error_limit: int=0) -> List[str]:
+                  use_shim: bool=True, error_limit: int=0,
+                  use_pch: bool=False) -> Tuple[str, ...]:
     """
     Get the Clang args to compile OpenCL.
 
+    The result is cached, as this is called several times for every file
+    which is preprocessed.
+
     Parameters
     ----------
     target : str
@@ -149,10 +249,14 @@ def clang_cl_args(target: str=CLANG_CL_TARGETS[0],
         Inject shim header.
     error_limit : int, optional
         Limit number of compiler errors.
+    use_pch : bool, optional
+        Inject the shim header as a precompiled header, if one can be built.
+        The PCH can only be read by the bundled clang, not by other tools
+        built against LLVM.
 
     Returns
     -------
-    List[str]
+    Tuple[str, ...]
         Array of args.
     """
     # clang warnings to disable
@@ -170,41 +274,127 @@ def clang_cl_args(target: str=CLANG_CL_TARGETS[0],
         '-xcl'
     ] + ['-Wno-{}'.format(x) for x in disabled_warnings]
 
-    if use_shim:
+    pch = _shim_pch(target) if use_shim and use_pch else None
+    if pch:
+        args += ['-include-pch', pch]
+    elif use_shim:
         args += ['-include', native.SHIMFILE]
 
-    return args
+    return tuple(args)
 
 
-def strip_preprocessor_lines(src: str) -> str:
-    lines = src.split('\n')
+@lru_cache(maxsize=1)
+def _shim_header_mtimes() -> Tuple[str, ...]:
+    """
+    Get the modification times of the shim header and the libclc headers.
+
+    Returns
+    -------
+    Tuple[str, ...]
+        A "<path>:<mtime>" string for every header.
+    """
+    paths = [native.SHIMFILE]
+    for root, _, files in os.walk(fs.path(native.LIBCLC)):
+        paths += [os.path.join(root, file) for file in files]
+    return tuple(f"{path}:{os.path.getmtime(path)}" for path in sorted(paths))
 
-    # Strip all the includes:
-    for i, line in enumerate(lines):
-        if line == '# 1 "<stdin>" 2':
-            break
-    lines = lines[i + 1:]
 
-    # Strip lines beginning with '#' (that's preprocessor
-    # stuff):
-    src = '\n'.join([line for line in lines if not line.startswith('#')])
+_SHIM_PCH_LOCK = Lock()
 
+
+@lru_cache(maxsize=8)
+def _shim_pch(target: str) -> str:
+    """
+    Get a precompiled shim header for an LLVM target.
+
+    The shim header and the libclc headers it includes are otherwise parsed
+    from scratch by every clang invocation. PCHs are built once and stored
+    in the cache, keyed by the target, compiler arguments, clang binary, and
+    headers. clang refuses to load a PCH if any of these have changed.
+
+    Parameters
+    ----------
+    target : str
+        LLVM target.
+
+    Returns
+    -------
+    str
+        Path to precompiled header, or None if it could not be built.
+    """
+    key = crypto.sha1_list(
+        target, *clang_cl_args(target, use_shim=False),
+        f"{native.CLANG}:{os.path.getmtime(native.CLANG)}",
+        *_shim_header_mtimes())
+
+    cache = clgen.mkcache("pch")
+
+    # Serialize builds, so that worker threads which all request the PCH at
+    # startup don't each build it.
+    with _SHIM_PCH_LOCK:
+        cached_path = cache.get(key)
+        if cached_path:
+            return cached_path
+
+        # Build to a temporary file and move it into place, so that
+        # concurrent processes never read a partially written PCH.
+        # '-Xclang -emit-pch' overrides the driver's compile action, while
+        # keeping the language and target options the driver derives from
+        # the other args, which clang requires to match when the PCH is used.
+        with NamedTemporaryFile(suffix='.pch', dir=cache.path,
+                                delete=False) as tmp:
+            pass
+        cmd = ([native.CLANG] + list(clang_cl_args(target, use_shim=False)) +
+               ['-c', native.SHIMFILE, '-o', tmp.name, '-Xclang', '-emit-pch'])
+        returncode, _, stderr = _communicate(cmd)
+        if returncode != 0:
+            os.remove(tmp.name)
+            log.warning("failed to precompile shim header:",
+                        stderr.decode('utf-8'))
+            return None
+
+        cache[key] = tmp.name
+        return cache[key]
+
+
+# Line marker emitted by clang on returning to <stdin> from the headers
+# which are included before it.
+_STDIN_MARKER = b'\n# 1 "<stdin>" 2\n'
+
+
+def _strip_includes(src: Union[str, bytes]) -> Union[str, bytes]:
+    """ discard preprocessor output up to the end of the included headers """
+    marker = (_STDIN_MARKER if isinstance(src, bytes)
+              else _STDIN_MARKER.decode('utf-8'))
+    idx = src.find(marker)
+    if idx >= 0:
+        src = src[idx + len(marker):]
     return src
 
 
+def _strip_directives(src: str) -> str:
+    """ strip lines beginning with '#' (that's preprocessor stuff) """
+    return '\n'.join([line for line in src.split('\n')
+                      if not line.startswith('#')])
+
+
+def strip_preprocessor_lines(src: str) -> str:
+    return _strip_directives(_strip_includes(src))
+
+
 def compiler_preprocess(src: str, compiler_args: List[str], id: str='anon',
                         timeout: int=60):
-    cmd = ["timeout", "-s9", str(timeout), native.CLANG] + compiler_args + [
-        '-E', '-c', '-', '-o', '-'
-    ]
-    process = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = process.communicate(src.encode('utf-8'))
-    if process.returncode != 0:
+    cmd = [native.CLANG] + list(compiler_args) + ['-E', '-c', '-', '-o', '-']
+    returncode, stdout, stderr = _communicate(cmd, src.encode('utf-8'),
+                                              timeout)
+    if returncode != 0:
         raise ClangException(stderr.decode('utf-8'))
 
-    src = stdout.decode('utf-8')
+    # The included headers make up the bulk of the output, so discard them
+    # before decoding:
+    src = _strip_includes(stdout).decode('utf-8')
 
-    return strip_preprocessor_lines(src)
+    return _strip_directives(src)
 
 
 def compiler_preprocess_cl(src: str, id: str='anon',
@@ -233,7 +423,12 @@ def compiler_preprocess_cl(src: str, id: str='anon',
     ClangException
         If compiler errors.
     """
-    return compiler_preprocess(src, clang_cl_args(use_shim=use_shim), id)
+    return compiler_preprocess(
+        src, clang_cl_args(use_shim=use_shim, use_pch=True), id)
+
+
+# Memory backed file system for short-lived temporary files, if available.
+_SHM_DIR = '/dev/shm' if os.access('/dev/shm', os.W_OK) else None
 
 
 def rewrite_cl(src: str, id: str='anon', use_shim: bool=True,
@@ -262,20 +457,20 @@ def rewrite_cl(src: str, id: str='anon', use_shim: bool=True,
     RewriterException
         If rewriter fails.
     """
-    # Rewriter can't read from stdin.
-    with NamedTemporaryFile('w', suffix='.cl') as tmp:
+    # Rewriter can't read from stdin. The '.cl' suffix is required for clang
+    # to infer the language, so we can't use an anonymous file either.
+    with NamedTemporaryFile('w', suffix='.cl', dir=_SHM_DIR) as tmp:
         tmp.write(src)
         tmp.flush()
-        cmd = (["timeout", "-s9", str(timeout), native.CLGEN_REWRITER, tmp.name] +
+        cmd = ([native.CLGEN_REWRITER, tmp.name] +
                ['-extra-arg=' + x
                 for x in clang_cl_args(use_shim=use_shim)] + ['--'])
 
-        process = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        stdout, stderr = process.communicate()
+        returncode, stdout, stderr = _communicate(cmd, timeout=timeout)
 
     # If there was nothing to rewrite, rewriter exits with error code:
     EUGLY_CODE = 204
-    if process.returncode == EUGLY_CODE:
+    if returncode == EUGLY_CODE:
         # Propagate the error:
         raise RewriterException(src)
     # NOTE: the rewriter process can still fail because of some other
@@ -311,14 +506,15 @@ def compile_cl_bytecode(src: str, id: str='anon', use_shim: bool=True,
     ClangException
         If compiler errors.
     """
-    cmd = ["timeout", "-s9", str(timeout), native.CLANG] + clang_cl_args(use_shim=use_shim) + [
+    cmd = [native.CLANG] + list(
+        clang_cl_args(use_shim=use_shim, use_pch=True)) + [
         '-emit-llvm', '-S', '-c', '-', '-o', '-'
     ]
 
-    process = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = process.communicate(src.encode('utf-8'))
+    returncode, stdout, stderr = _communicate(cmd, src.encode('utf-8'),
+                                              timeout)
 
-    if process.returncode != 0:
+    if returncode != 0:
         raise ClangException(stderr.decode('utf-8'))
     return stdout
 
@@ -355,31 +551,31 @@ def gpuverify(src: str, args: list, id: str='anon', timeout: int=60) -> str:
     with NamedTemporaryFile('w', suffix='.cl') as tmp:
         tmp.write(src)
         tmp.flush()
-        cmd = ['timeout', '-s9', str(timeout), native.GPUVERIFY, tmp.name] + args
+        cmd = [native.GPUVERIFY, tmp.name] + args
 
-        process = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        stdout, stderr = process.communicate()
+        returncode, stdout, stderr = _communicate(cmd, timeout=timeout)
 
-    if process.returncode == -9:  # timeout signal
+    if returncode == -9:  # timeout signal
         raise GPUVerifyTimeoutException(f"GPUveryify failed to complete with {timeout} seconds")
-    elif process.returncode != 0:
+    elif returncode != 0:
         raise GPUVerifyException(stderr.decode('utf-8'))
 
     return src
 
 
 _instcount_re = re.compile(
-    r"^(?P<count>\d+) instcount - Number of (?P<type>.+)")
+    br"^[ \t]*(?P<count>\d+) instcount - Number of (?P<type>.+?)\s*$",
+    re.MULTILINE)
 
 
-def parse_instcounts(txt: str) -> Dict[str, int]:
+def parse_instcounts(txt: Union[str, bytes]) -> Dict[str, int]:
     """
     Parse LLVM opt instruction counts pass.
 
     Parameters
     ----------
-    txt : str
-        LLVM output.
+    txt : Union[str, bytes]
+        LLVM output. Passing the raw bytes avoids decoding the whole output.
 
     Returns
     -------
@@ -387,25 +583,14 @@ def parse_instcounts(txt: str) -> Dict[str, int]:
         key, value pairs, where key is instruction type and value is
         instruction type count.
     """
-    lines = [x.strip() for x in txt.split("\n")]
-    counts = {}
-
-    # Build a list of counts for each type.
-    for line in lines:
-        match = re.search(_instcount_re, line)
-        if match:
-            count = int(match.group("count"))
-            key = match.group("type")
-            if key in counts:
-                counts[key].append(count)
-            else:
-                counts[key] = [count]
-
-    # Sum all counts.
-    for key in counts:
-        counts[key] = sum(counts[key])
+    if isinstance(txt, str):
+        txt = txt.encode('utf-8')
+
+    counts = Counter()
+    for count, key in _instcount_re.findall(txt):
+        counts[key.decode('utf-8')] += int(count)
 
-    return counts
+    return dict(counts)
 
 
 def instcounts2ratios(counts: Dict[str, int]) -> Dict[str, float]:
@@ -470,21 +655,109 @@ def bytecode_features(bc: str, id: str='anon', timeout: int=60) -> Dict[str, flo
     OptException
         If LLVM opt pass errors.
     """
-    cmd = ["timeout", "-s9", str(timeout), native.OPT, '-analyze', '-stats', '-instcount', '-']
+    cmd = [native.OPT, '-analyze', '-stats', '-instcount', '-']
 
     # LLVM pass output pritns to stderr, so we'll pipe stderr to
     # stdout.
-    process = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-    stdout, _ = process.communicate(bc)
+    returncode, stdout, _ = _communicate(cmd, bc, timeout, stderr=STDOUT)
+
+    if returncode != 0:
+        raise OptException(stdout.decode('utf-8'))
+
+    instcounts = parse_instcounts(stdout)
+    instratios = instcounts2ratios(instcounts)
+
+    return instratios
+
+def compile_cl_bytecode_features(src: str, id: str='anon',
+                                 use_shim: bool=True,
+                                 timeout: int=60) -> Dict[str, float]:
+    """
+    Compile OpenCL kernel and extract features from the bytecode.
+
+    Equivalent to bytecode_features(compile_cl_bytecode(src)), but clang
+    output is piped directly into opt, rather than being read back into
+    Python in between.
+
+    Parameters
+    ----------
+    src : str
+        OpenCL source.
+    id : str, optional
+        Name of OpenCL source.
+    use_shim : bool, optional
+        Inject shim header.
+
+    Returns
+    -------
+    Dict[str, float]
+        Key value pairs of instruction types and densities.
 
-    if process.returncode != 0:
+    Raises
+    ------
+    ClangException
+        If compiler errors.
+    OptException
+        If LLVM opt pass errors.
+    """
+    clang_cmd = [native.CLANG] + list(
+        clang_cl_args(use_shim=use_shim, use_pch=True)) + [
+        '-emit-llvm', '-S', '-c', '-', '-o', '-'
+    ]
+    opt_cmd = [native.OPT, '-analyze', '-stats', '-instcount', '-']
+
+    # clang stderr goes to a file so that a large volume of compiler
+    # errors cannot fill the pipe and deadlock the pipeline.
+    with TemporaryFile() as clang_stderr:
+        deadline = time.monotonic() + timeout
+
+        # Each process runs in a new session so that on timeout its children
+        # (e.g. clang -cc1) can be killed too. See _communicate().
+        clang = Popen(clang_cmd, stdin=PIPE, stdout=PIPE, stderr=clang_stderr,
+                      start_new_session=True)
+        # LLVM pass output prints to stderr, so we'll pipe stderr to
+        # stdout.
+        opt = Popen(opt_cmd, stdin=clang.stdout, stdout=PIPE, stderr=STDOUT,
+                    start_new_session=True)
+        # Allow clang to receive SIGPIPE if opt exits early.
+        clang.stdout.close()
+
+        # Write the input from a thread, so that the deadline also covers a
+        # clang which doesn't read its input.
+        writer = Thread(target=_write_stdin,
+                        args=(clang, src.encode('utf-8')), daemon=True)
+        writer.start()
+
+        try:
+            stdout, _ = opt.communicate(
+                timeout=max(deadline - time.monotonic(), 0))
+        except TimeoutExpired:
+            _kill_process_group(clang)
+            _kill_process_group(opt)
+            stdout, _ = opt.communicate()
+
+        try:
+            clang.wait(timeout=max(deadline - time.monotonic(), 0))
+        except TimeoutExpired:
+            _kill_process_group(clang)
+            clang.wait()
+
+        # clang has exited, so the write either completed or failed.
+        writer.join()
+
+        if clang.returncode != 0:
+            clang_stderr.seek(0)
+            raise ClangException(clang_stderr.read().decode('utf-8'))
+
+    if opt.returncode != 0:
         raise OptException(stdout.decode('utf-8'))
 
-    instcounts = parse_instcounts(stdout.decode('utf-8'))
+    instcounts = parse_instcounts(stdout)
     instratios = instcounts2ratios(instcounts)
 
     return instratios
 
+
 # Options to pass to clang-format.
 #
 # See: http://clang.llvm.org/docs/ClangFormatStyleOptions.html
@@ -524,14 +797,14 @@ def clangformat(src: str, id: str='anon', timeout: int=60) -> str:
     ClangFormatException
         If formatting errors.
     """
-    cmd = ["timeout", "-s9", str(timeout), native.CLANG_FORMAT, '-style={}'.format(
+    cmd = [native.CLANG_FORMAT, '-style={}'.format(
         json.dumps(clangformat_config))]
-    process = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = process.communicate(src.encode('utf-8'))
+    returncode, stdout, stderr = _communicate(cmd, src.encode('utf-8'),
+                                              timeout)
 
     if stderr:
         log.error(stderr.decode('utf-8'))
-    if process.returncode != 0:
+    if returncode != 0:
         raise ClangFormatException(stderr.decode('utf-8'))
 
     return stdout.decode('utf-8')
@@ -681,8 +954,7 @@ def preprocess_opencl(src: str, id: str='anon', use_shim: bool=True,
         Whether to run GPUVerify on the code.
     """
     # Compile to bytecode and verify features:
-    bc = compile_cl_bytecode(src, id, use_shim)
-    bc_features = bytecode_features(bc, id)
+    bc_features = compile_cl_bytecode_features(src, id, use_shim)
     verify_bytecode_features(bc_features, id)
 
     # Rewrite and format source:
@@ -759,10 +1031,61 @@ def preprocess(src: str, id: str="anon", lang: clgen.Language=clgen.Language.OPE
         raise ValueError(f"unsuporrted language '{lang}'")
 
 
+# Version of the preprocess cache entry format. Bump this when changing the
+# format, so that existing entries are not read.
+_PREPROCESS_CACHE_FORMAT = "status-line-v1"
+
+# Lazily initialized, see _preprocess_cache() and _preprocess_signature():
+_PREPROCESS_CACHE = None
+_PREPROCESS_SIGNATURE = None
+
+
+def _preprocess_cache():
+    """
+    Get the file system cache of preprocess_for_db() results.
+
+    Returns
+    -------
+    labm8.FSCache
+        Filesystem cache.
+    """
+    global _PREPROCESS_CACHE
+    if _PREPROCESS_CACHE is None:
+        _PREPROCESS_CACHE = clgen.mkcache("preprocess")
+    return _PREPROCESS_CACHE
+
+
+def _preprocess_signature() -> str:
+    """
+    Get a checksum of the preprocessing toolchain.
+
+    Cached results are invalidated if the CLgen version, compiler arguments,
+    code style, shim and libclc headers, or any of the native binaries change.
+
+    Returns
+    -------
+    str
+        Checksum.
+    """
+    global _PREPROCESS_SIGNATURE
+    if _PREPROCESS_SIGNATURE is None:
+        binaries = [native.CLANG, native.CLANG_FORMAT, native.CLGEN_REWRITER,
+                    native.OPT]
+        _PREPROCESS_SIGNATURE = crypto.sha1_list(
+            clgen.version(), *clang_cl_args(),
+            json.dumps(clangformat_config, sort_keys=True),
+            *[f"{path}:{os.path.getmtime(path)}" for path in binaries],
+            *_shim_header_mtimes())
+    return _PREPROCESS_SIGNATURE
+
+
 def preprocess_for_db(src: str, **preprocess_opts) -> Tuple[int, str]:
     """
     Preprocess source code for import into contentdb.
 
+    Results are memoized on disk, keyed by the source code, preprocessing
+    options, and toolchain, so duplicate sources are only preprocessed once.
+
     Parameters
     ----------
     src : str
@@ -775,6 +1098,37 @@ def preprocess_for_db(src: str, **preprocess_opts) -> Tuple[int, str]:
     Tuple[int, str]
         The status of the preprocessed code, and the preprocess output.
     """
+    # The source ID is only used in error messages, so it is not part of the
+    # key.
+    opts = sorted(f"{k}={v}" for k, v in preprocess_opts.items() if k != "id")
+    key = crypto.sha1_list(_PREPROCESS_CACHE_FORMAT, _preprocess_signature(),
+                           *opts, src)
+
+    # Cache entries are the status on the first line, followed by the raw
+    # contents. This avoids the cost of JSON encoding the contents.
+    cache = _preprocess_cache()
+    cached_path = cache.get(key)
+    if cached_path:
+        with open(cached_path, encoding="utf-8", newline="") as infile:
+            status = int(infile.readline())
+            contents = infile.read()
+        return status, contents
+
+    status, contents = _preprocess_for_db(src, **preprocess_opts)
+
+    # Write to a temporary file and move it into place, so that concurrent
+    # workers never read a partially written entry:
+    with NamedTemporaryFile("w", encoding="utf-8", newline="", dir=cache.path,
+                            delete=False) as tmp:
+        tmp.write(f"{status}\n")
+        tmp.write(contents)
+    cache[key] = tmp.name
+
+    return status, contents
+
+
+def _preprocess_for_db(src: str, **preprocess_opts) -> Tuple[int, str]:
+    """ uncached implementation of preprocess_for_db() """
     try:
         # Try and preprocess it:
         status = 0
@@ -818,13 +1172,57 @@ def preprocess_file(path: str, inplace: bool=False, **preprocess_opts) -> None:
         log.fatal(e, ret=2)
 
 
+# Lazily initialized by _get_pool():
+_POOL = None
+_POOL_SIZE = None
+
+
+def _get_pool(num_workers: int) -> Pool:
+    """
+    Get a process pool with the given number of workers.
+
+    The pool is shared between calls, since forking new workers for every
+    call dominates the cost of preprocessing a small number of files. It is
+    recreated if a different number of workers is requested, so callers
+    should request a fixed number, not one derived from the size of the job.
+
+    Parameters
+    ----------
+    num_workers : int
+        Number of worker processes.
+
+    Returns
+    -------
+    Pool
+        Process pool.
+    """
+    global _POOL
+    global _POOL_SIZE
+    if _POOL is None or _POOL_SIZE != num_workers:
+        _terminate_pool()
+        _POOL = Pool(num_workers)
+        _POOL_SIZE = num_workers
+    return _POOL
+
+
+@atexit.register
+def _terminate_pool() -> None:
+    """ terminate the process pool, if any """
+    global _POOL
+    global _POOL_SIZE
+    if _POOL is not None:
+        _POOL.terminate()
+        _POOL = None
+        _POOL_SIZE = None
+
+
 def _preprocess_inplace_worker(path: str) -> None:
     """worker function for preprocess_inplace()"""
     log.info('preprocess', path)
     preprocess_file(path, inplace=True)
 
 
-def preprocess_inplace(paths: List[str], max_num_workers: int=cpu_count(),
+def preprocess_inplace(paths: List[str], max_num_workers: int=_num_cpus(),
                        max_attempts: int=100, attempt: int=1) -> None:
     """
     Preprocess a list of files in place.
@@ -845,16 +1243,19 @@ def preprocess_inplace(paths: List[str], max_num_workers: int=cpu_count(),
     elif attempt > 1:
         log.warning("preprocess attempt #.", attempt)
 
-    num_workers = min(len(paths), max_num_workers)
-
     try:
-        log.info('spawned', num_workers, 'worker threads to process',
+        log.info('using', max_num_workers, 'worker processes to process',
                  len(paths), 'files ...')
-        with clgen.terminating(Pool(num_workers)) as pool:
-            pool.map(_preprocess_inplace_worker, paths)
+        # The pool is sized by max_num_workers rather than the number of
+        # paths, so that it can be reused by calls with different numbers of
+        # paths.
+        _get_pool(max_num_workers).map(_preprocess_inplace_worker, paths)
     except (OSError, TimeoutError) as e:
         log.error(e)
 
+        # The pool may be in a bad state, so don't reuse it.
+        _terminate_pool()
+
         # Try again with fewer threads.
         # See: https://github.com/ChrisCummins/clgen/issues/64
         max_num_workers = max(int(max_num_workers / 2), 1)
@@ -863,33 +1264,78 @@ def preprocess_inplace(paths: List[str], max_num_workers: int=cpu_count(),
 
 
 class PreprocessWorker(Thread):
-    """ preprocessor worker thread """
+    """
+    Preprocessor worker thread.
+
+    Workers pull jobs from a shared deque until it is empty. deque.popleft()
+    is atomic, so no additional locking is required.
+    """
 
-    def __init__(self, jobs: List[Dict], queue: Queue):
+    def __init__(self, jobs: deque, queue: Queue):
         super(PreprocessWorker, self).__init__()
         self.jobs = jobs
         self.queue = queue
 
     def run(self):
-        while self.jobs:
-            job = self.jobs.pop(0)
+        while True:
+            try:
+                job = self.jobs.popleft()
+            except IndexError:
+                return
 
             kid = job["id"]
             src = job["src"]
             preprocess_opts = job["preprocess_opts"]
 
-            status, contents = preprocess_for_db(src, id=id, **preprocess_opts)
+            status, contents = preprocess_for_db(src, id=kid, **preprocess_opts)
+
+            # results are pushed as (id, status, contents) rows, ready to be
+            # inserted into the PreprocessedFiles table
+            self.queue.put((kid, status, contents))
 
-            result = {
-                "id": kid,
-                "status": status,
-                "contents": contents
-            }
 
-            self.queue.put(result)
+def _connect(db_path: str):
+    """
+    Returns a connection to a database, tuned for bulk reads.
+
+    Content databases are dominated by large text blobs, so the connection
+    memory-maps the database file and uses a large page cache.
+
+    Parameters
+    ----------
+    db_path : str
+        Path to database.
+
+    Returns
+    -------
+    sqlite3.Connection
+        Database connection.
+    """
+    db = dbutil.connect(db_path)
+    db.execute("PRAGMA mmap_size={}".format(1 << 32))
+    db.execute("PRAGMA cache_size=-262144")  # 256 MiB
+    db.execute("PRAGMA temp_store=MEMORY")
+    return db
 
 
-def _preprocess_db(db_path: str, max_num_workers: int=cpu_count(),
+def _insert_preprocessed_files(db, results: List[Tuple[str, int, str]]) -> None:
+    """
+    Insert preprocessed results into database in a single transaction.
+
+    Parameters
+    ----------
+    db : sqlite3.Connection
+        Database.
+    results : List[Tuple[str, int, str]]
+        Tuples of kernel ID, preprocess status, and preprocessed contents.
+    """
+    c = db.cursor()
+    c.executemany("INSERT INTO PreprocessedFiles VALUES(?,?,?)", results)
+    c.close()
+    db.commit()
+
+
+def _preprocess_db(db_path: str, max_num_workers: int=_num_cpus(),
                    max_attempts: int=100, attempt: int=1,
                    **preprocess_opts) -> None:
     """
@@ -932,40 +1378,51 @@ def _preprocess_db(db_path: str, max_num_workers: int=cpu_count(),
     log.verbose("creating jobs")
 
     # Determine if we need to inline kernels when creating jobs
-    db = sqlite3.connect(db_path)
+    db = _connect(db_path)
     c = db.cursor()
     c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='ContentMeta';")
     meta_table = c.fetchone()
-    c.close()
-    db.close()
-    if meta_table:
-        get_kernel = lambda kid: dbutil.get_inlined_kernel(db_path, kid, lang=preprocess_opts["lang"])
-    else:
-        get_kernel = lambda kid: dbutil.get_kernel(db_path, kid, table="ContentFiles")
 
     # create jobs
-    jobs = [{
-        "id": kid,
-        "src": get_kernel(kid),
-        "preprocess_opts": preprocess_opts,
-    } for kid in todo]
-
-    random.shuffle(jobs)
+    if meta_table:
+        jobs = [{
+            "id": kid,
+            "src": dbutil.get_inlined_kernel(db_path, kid,
+                                             lang=preprocess_opts["lang"]),
+            "preprocess_opts": preprocess_opts,
+        } for kid in todo]
+    else:
+        # Fetch all of the contents in a single query, rather than issuing
+        # a query per kernel. Rows are streamed from the cursor so that the
+        # contents of already preprocessed files are never held in memory.
+        jobs = [{
+            "id": kid,
+            "src": contents,
+            "preprocess_opts": preprocess_opts,
+        } for kid, contents in c.execute("SELECT id,contents FROM ContentFiles")
+            if kid in todo]
+    c.close()
+    db.close()
 
-    # split size
-    worker_njobs = math.ceil(ntodo / max_num_workers)
+    # a single job queue shared by all workers, so that a worker which
+    # draws a run of slow files doesn't hold up the others
+    jobs = deque(jobs)
+    num_workers = min(ntodo, max_num_workers)
 
     # producer-consumer queue
     queue = Queue(maxsize=128)
 
-    log.verbose(f"assigning {ntodo} jobs to {max_num_workers} threads")
+    # buffer of results waiting to be inserted into the database
+    db = _connect(db_path)
+    results = []
+
+    log.verbose(f"assigning {ntodo} jobs to {num_workers} threads")
 
     try:
         # our worker threads. these busy little bees will do the heavy lifting
         # of preprocessing the contentfiles, pushing their results onto
         # the queue
-        producers = [PreprocessWorker(jobs[i:i+worker_njobs], queue)
-                     for i in range(0, ntodo, worker_njobs)]
+        producers = [PreprocessWorker(jobs, queue) for _ in range(num_workers)]
 
         # fly, my pretties, fly!
         for producer in producers:
@@ -981,14 +1438,14 @@ def _preprocess_db(db_path: str, max_num_workers: int=cpu_count(),
                     'failed to fetch result after 90 seconds. '
                     'something went wrong') from e
 
-            # insert result into database
-            db = dbutil.connect(db_path)
-            c = db.cursor()
-            c.execute("INSERT INTO PreprocessedFiles VALUES(?,?,?)",
-                      (result["id"], result["status"], result["contents"]))
-            c.close()
-            db.commit()
-            db.close()
+            # insert results into database in batches
+            results.append(result)
+            if len(results) >= 128:
+                _insert_preprocessed_files(db, results)
+                results = []
+
+        _insert_preprocessed_files(db, results)
+        db.close()
 
         for producer in producers:
             producer.join()
@@ -996,6 +1453,10 @@ def _preprocess_db(db_path: str, max_num_workers: int=cpu_count(),
     except (OSError, TimeoutError) as e:
         log.error(e)
 
+        # keep the results we've got so far
+        _insert_preprocessed_files(db, results)
+        db.close()
+
         if attempt > 2 and not i:
             log.warning("no progress has been made since previous attempt. "
                         "I'm not going to try another attempt.")
@@ -1024,7 +1485,7 @@ def preprocess_db(db_path: str, **preprocess_opts) -> bool:
     bool
         True if modified, false if no work needed.
     """
-    db = dbutil.connect(db_path)
+    db = _connect(db_path)
 
     modified = dbutil.is_modified(db)
     if modified:
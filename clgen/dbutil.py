@@ -25,7 +25,7 @@ import re
 import sys
 import sqlite3
 
-from hashlib import md5
+from hashlib import blake2b, md5
 from labm8 import fs
 from typing import List
 
@@ -67,7 +67,9 @@ class md5sum_aggregator:
         self.md5 = md5()
 
     def step(self, value) -> None:
-        self.md5.update(str(value).encode('utf-8'))
+        if not isinstance(value, bytes):
+            value = str(value).encode('utf-8')
+        self.md5.update(value)
 
     def finalize(self) -> str:
         return self.md5.hexdigest()
@@ -102,6 +104,27 @@ def linecount(t: str) -> int:
     return len(t.split('\n'))
 
 
+def sql_linecount(column: str) -> str:
+    """
+    SQL expression for the line count of a text column.
+
+    Equivalent to LC_col(), but evaluated natively by SQLite rather than
+    calling back into Python for every row.
+
+    Parameters
+    ----------
+    column : str
+        Column name.
+
+    Returns
+    -------
+    str
+        SQL expression.
+    """
+    return ("(length({column}) - length(replace({column}, char(10), '')) + 1)"
+            .format(column=column))
+
+
 class charcount_aggregator:
     """
     sqlite3 aggregator for computing character count of column values.
@@ -127,6 +150,9 @@ def connect(db_path: str):
      * CC() returns sum character count of text columns
      * LC_col() returns line count of text value
 
+    These are evaluated in Python for every row. Where possible, prefer
+    native SQL, e.g. SUM(length(col)) over CC(col), and sql_linecount().
+
     Parameters
     ----------
     db_path : str
@@ -361,6 +387,32 @@ def run_script(path: str, script: str) -> None:
     db.close()
 
 
+def _contentfiles_checksum(c) -> str:
+    """
+    Checksum of the IDs in the ContentFiles table.
+
+    The IDs are concatenated by SQLite, in the order of the index on the id
+    column, and hashed in a single call with BLAKE2b, which is faster than
+    MD5 in software. This avoids calling back into Python for every row, as
+    an aggregate function would, while still detecting any change to the set
+    of IDs.
+
+    Parameters
+    ----------
+    c : sqlite3.Cursor
+        Database cursor.
+
+    Returns
+    -------
+    str
+        Checksum.
+    """
+    c.execute("SELECT group_concat(id, char(10)) FROM "
+              "(SELECT id FROM ContentFiles ORDER BY id)")
+    ids = c.fetchone()[0] or ""
+    return blake2b(ids.encode('utf-8'), digest_size=16).hexdigest()
+
+
 def is_modified(db) -> bool:
     """
     Returns whether database is preprocessed.
@@ -381,8 +433,7 @@ def is_modified(db) -> bool:
     result = c.fetchone()
     cached_checksum = result[0] if result else None
 
-    c.execute('SELECT MD5SUM(id) FROM ContentFiles')
-    checksum = c.fetchone()[0]
+    checksum = _contentfiles_checksum(c)
     c.close()
 
     return False if cached_checksum == checksum else checksum
@@ -537,7 +588,7 @@ def cc(path: str, table: str, column: str="Contents", condition: str="") -> int:
     """
     db = connect(path)
     c = db.cursor()
-    c.execute("SELECT CC({column}) FROM {table} {condition}"
+    c.execute("SELECT SUM(length({column})) FROM {table} {condition}"
               .format(column=column, table=table, condition=condition))
     return c.fetchone()[0] or 0
 
@@ -562,8 +613,9 @@ def lc(path: str, table: str, column: str="Contents", condition: str="") -> int:
     """
     db = connect(path)
     c = db.cursor()
-    c.execute("SELECT LC({column}) FROM {table} {condition}"
-              .format(column=column, table=table, condition=condition))
+    c.execute("SELECT SUM({lc}) FROM {table} {condition}"
+              .format(lc=sql_linecount(column), table=table,
+                      condition=condition))
     return c.fetchone()[0] or 0
 
 
@@ -653,8 +705,9 @@ def sql_insert_dict(c, table: str, data: dict, ignore_existing: bool=False,
     c.execute(cmd, tuple([data[v] for v in sorted(data.keys())]))
 
 
-_sql_rm_chars = re.compile(r'[\(\)]')
-_sql_sub_chars = re.compile(r'-')
+# Translation table for escape_sql_key(). Removes parentheses, and replaces
+# spaces and hyphens with underscores.
+_sql_key_table = str.maketrans({'(': None, ')': None, ' ': '_', '-': '_'})
 
 
 def escape_sql_key(key: str) -> str:
@@ -671,8 +724,7 @@ def escape_sql_key(key: str) -> str:
     str
         Escaped key.
     """
-    return re.sub(_sql_sub_chars, '_',
-                  re.sub(_sql_rm_chars, '', '_'.join(key.split(' '))))
+    return key.translate(_sql_key_table)
 
 
 def kid_to_path(id: str) -> str:
@@ -741,7 +793,7 @@ def _dump_db(db, out_path: str, gh: bool=False, fileid: bool=False,
                   .format(table))
         orderby = 'Repositories.stars'
     else:
-        orderby = 'LC_col(contents)'
+        orderby = sql_linecount('contents')
 
     query = ('{select} FROM {table} {qualifier} ORDER BY {orderby} {order}'
              .format(select=select, table=table, qualifier=qualifier,
@@ -761,16 +813,17 @@ def _dump_db(db, out_path: str, gh: bool=False, fileid: bool=False,
                 out.write(contents)
     else:
         log.info('writing file', out_path)
-        with open(out_path, 'wb') as out:
+        # Print EOF token
+        separator = b'\n/* EOF */\n\n' if eof else b'\n\n'
+        # Use a large write buffer so that the many small per-file writes
+        # are coalesced into few system calls.
+        with open(out_path, 'wb', buffering=1 << 20) as out:
             for row in rows:
                 id, contents = row
                 if fileid:  # Print file ID
                     out.write('/* ID: {} */\n\n'.format(id).encode('utf-8'))
                 out.write(contents.encode('utf-8'))
-                if eof:  # Print EOF token
-                    out.write('\n/* EOF */\n\n'.encode('utf-8'))
-                else:
-                    out.write('\n\n'.encode('utf-8'))
+                out.write(separator)
 
 
 def dump_db(db_path: str, out_path: str, **kwargs) -> None:
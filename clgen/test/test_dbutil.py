@@ -83,3 +83,60 @@ def test_insert():
     dbutil.remove_preprocessed(db_path)
     assert dbutil.num_rows_in(db_path, "ContentFiles") == 1
     assert dbutil.num_rows_in(db_path, "PreprocessedFiles") == 0
+
+
+def test_is_modified():
+    db_path = tests.data_path("db", "tmp.db", exists=False)
+    fs.rm(db_path)
+
+    dbutil.create_db(db_path)
+    db = dbutil.connect(db_path)
+    c = db.cursor()
+    dbutil.sql_insert_dict(c, "ContentFiles", {"id": "a", "contents": "foo"})
+    db.commit()
+
+    checksum = dbutil.is_modified(db)
+    assert checksum
+    dbutil.set_modified_status(db, checksum)
+    assert not dbutil.is_modified(db)
+
+    # replacing the last row is a modification
+    c.execute("DELETE FROM ContentFiles WHERE id='a'")
+    dbutil.sql_insert_dict(c, "ContentFiles", {"id": "b", "contents": "foo"})
+    db.commit()
+    assert dbutil.is_modified(db)
+
+    checksum = dbutil.is_modified(db)
+    dbutil.set_modified_status(db, checksum)
+    assert not dbutil.is_modified(db)
+
+    # replacing rows such that the rowids, row count, and last ID are
+    # unchanged is a modification
+    for kid in "cde":
+        dbutil.sql_insert_dict(c, "ContentFiles", {"id": kid, "contents": "foo"})
+    db.commit()
+    dbutil.set_modified_status(db, dbutil.is_modified(db))
+    c.execute("DELETE FROM ContentFiles WHERE id IN ('d', 'e')")
+    dbutil.sql_insert_dict(c, "ContentFiles", {"id": "z", "contents": "foo"})
+    dbutil.sql_insert_dict(c, "ContentFiles", {"id": "e", "contents": "foo"})
+    db.commit()
+    assert dbutil.is_modified(db)
+
+    # in-place updates of IDs are a modification
+    dbutil.set_modified_status(db, dbutil.is_modified(db))
+    c.execute("UPDATE ContentFiles SET id='y' WHERE id='z'")
+    db.commit()
+    assert dbutil.is_modified(db)
+
+    # removing the recorded checksum is a modification
+    dbutil.set_modified_status(db, dbutil.is_modified(db))
+    assert not dbutil.is_modified(db)
+    dbutil.remove_preprocessed(db_path)
+    assert dbutil.is_modified(db)
+
+
+def test_escape_sql_key():
+    assert dbutil.escape_sql_key("instructions (of all types)") == \
+        "instructions_of_all_types"
+    assert dbutil.escape_sql_key("ratio_Call-Site insts") == \
+        "ratio_Call_Site_insts"
@@ -22,6 +22,7 @@ from clgen import test as tests
 import os
 import sqlite3
 import sys
+import time
 
 import labm8
 from labm8 import fs
@@ -58,6 +59,16 @@ def preprocess_pair(basename, preprocessor=clgen.preprocess):
     return (gs, tout)
 
 
+def test_communicate_timeout():
+    # the timeout is enforced even if the command has started child processes
+    # which hold its stdout and stderr open
+    start = time.time()
+    returncode, _, _ = clgen._preprocess._communicate(
+        ["sh", "-c", "sleep 10 & wait"], timeout=1)
+    assert returncode == -9
+    assert time.time() - start < 5
+
+
 def test_preprocess():
     assert len(set(preprocess_pair('sample-1'))) == 1
 
@@ -108,6 +119,152 @@ __kernel void A(__global float* a) {
         assert out == code
 
 
+@pytest.fixture
+def preprocess_cache(tmpdir, monkeypatch):
+    """ an empty preprocess cache, and a list of uncached preprocess calls """
+    monkeypatch.setenv("CLGEN_CACHE", str(tmpdir))
+    monkeypatch.setattr(clgen._preprocess, "_PREPROCESS_CACHE", None)
+
+    calls = []
+
+    def _preprocess_for_db(src, **preprocess_opts):
+        calls.append((src, preprocess_opts))
+        if src.startswith("bad"):
+            return 1, "bad code"
+        elif src.startswith("raw"):
+            return 0, src[len("raw"):]
+        return 0, src.upper()
+
+    monkeypatch.setattr(clgen._preprocess, "_preprocess_for_db",
+                        _preprocess_for_db)
+    return calls
+
+
+def test_preprocess_for_db_memoized(preprocess_cache):
+    assert clgen.preprocess_for_db("abc", id="a") == (0, "ABC")
+    assert len(preprocess_cache) == 1
+
+    # second call is served from the cache
+    assert clgen.preprocess_for_db("abc", id="a") == (0, "ABC")
+    assert len(preprocess_cache) == 1
+
+    # the source ID is not part of the key
+    assert clgen.preprocess_for_db("abc", id="b") == (0, "ABC")
+    assert len(preprocess_cache) == 1
+
+    # bad or ugly statuses are memoized too
+    assert clgen.preprocess_for_db("bad", id="a") == (1, "bad code")
+    assert clgen.preprocess_for_db("bad", id="a") == (1, "bad code")
+    assert len(preprocess_cache) == 2
+
+
+def test_preprocess_for_db_memoized_newlines(preprocess_cache):
+    # cached contents round trip exactly, including leading and CRLF newlines
+    src = "raw\nint a;\r\nint b;\r\n\n"
+    assert clgen.preprocess_for_db(src) == (0, "\nint a;\r\nint b;\r\n\n")
+    assert clgen.preprocess_for_db(src) == (0, "\nint a;\r\nint b;\r\n\n")
+    assert len(preprocess_cache) == 1
+
+
+def test_preprocess_for_db_memoized_opts(preprocess_cache):
+    clgen.preprocess_for_db("abc", use_shim=True)
+    assert len(preprocess_cache) == 1
+
+    # changing preprocess options misses the cache
+    clgen.preprocess_for_db("abc", use_shim=False)
+    assert len(preprocess_cache) == 2
+
+    clgen.preprocess_for_db("abc", use_shim=True)
+    assert len(preprocess_cache) == 2
+
+
+def test_parse_instcounts():
+    txt = """\
+===-------------------------------------------------------------------------===
+                          ... Statistics Collected ...
+===-------------------------------------------------------------------------===
+
+ 2 instcount - Number of Add insts
+ 1 instcount - Number of Add insts
+10 instcount - Number of instructions (of all types)
+"""
+    assert clgen.parse_instcounts(txt) == {
+        "Add insts": 3,
+        "instructions (of all types)": 10,
+    }
+    # raw opt output may be passed without decoding
+    assert clgen.parse_instcounts(txt.encode("utf-8")) == \
+        clgen.parse_instcounts(txt)
+    assert clgen.parse_instcounts("") == {}
+
+
+def test_compile_cl_bytecode_features():
+    code = """\
+__kernel void A(__global float* a) {
+  int b = get_global_id(0);
+  a[b] *= 2.0f;
+}"""
+    # fused clang | opt pipeline matches the two step equivalent
+    assert (clgen.compile_cl_bytecode_features(code) ==
+            clgen.bytecode_features(clgen.compile_cl_bytecode(code)))
+
+    with pytest.raises(clgen.ClangException):
+        clgen.compile_cl_bytecode_features("__kernel void A() { undefined; }")
+
+
+def test_compile_cl_bytecode_features_timeout(monkeypatch, tmpdir):
+    # the timeout is enforced even if clang never reads its input
+    clang = tmpdir.join("clang")
+    clang.write("#!/bin/sh\nsleep 30\n")
+    clang.chmod(0o755)
+    monkeypatch.setattr(clgen.native, "CLANG", str(clang))
+    monkeypatch.setattr(clgen._preprocess, "clang_cl_args",
+                        lambda **kwargs: ())
+    start = time.time()
+    with pytest.raises(clgen.ClangException):
+        clgen.compile_cl_bytecode_features("x" * 10 ** 7, timeout=1)
+    assert time.time() - start < 5
+
+
+def test_shim_pch(tmpdir, monkeypatch):
+    # FLOAT_T is defined in shim header
+    code = """\
+__kernel void A(__global FLOAT_T* a) {
+  int b = get_global_id(0);
+  a[b] *= 2.0f;
+}"""
+    monkeypatch.setenv("CLGEN_CACHE", str(tmpdir))
+    clgen._preprocess._shim_pch.cache_clear()
+    clgen._preprocess.clang_cl_args.cache_clear()
+    try:
+        pch = clgen._preprocess._shim_pch(clgen.CLANG_CL_TARGETS[0])
+        assert pch
+        assert pch.startswith(str(tmpdir))
+        assert "-include-pch" in clgen.clang_cl_args(use_pch=True)
+        with_pch = clgen.compile_cl_bytecode_features(code)
+        preprocessed_with_pch = clgen.compiler_preprocess_cl(code)
+
+        # without a PCH, the shim header is included from source
+        monkeypatch.setattr(clgen._preprocess, "_shim_pch",
+                            lambda target: None)
+        clgen._preprocess.clang_cl_args.cache_clear()
+        assert "-include-pch" not in clgen.clang_cl_args(use_pch=True)
+        without_pch = clgen.bytecode_features(clgen.compile_cl_bytecode(code))
+        preprocessed_without_pch = clgen.compiler_preprocess_cl(code)
+    finally:
+        monkeypatch.undo()
+        clgen._preprocess._shim_pch.cache_clear()
+        clgen._preprocess.clang_cl_args.cache_clear()
+
+    assert with_pch
+    assert with_pch == without_pch
+
+    # only the kernel remains, with or without the PCH
+    assert preprocessed_with_pch.startswith("__kernel void A")
+    assert '"<stdin>"' not in preprocessed_with_pch
+    assert preprocessed_with_pch == preprocessed_without_pch
+
+
 @tests.needs_linux  # FIXME: GPUVerify support on macOS.
 def test_gpuverify():
     code = """\